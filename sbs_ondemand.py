@@ -16,21 +16,19 @@
 
 
 import argparse
-import chardet
+import concurrent.futures
 import json
 import logging
-import multiprocessing
 import os
 import signal
 import sqlite3
 import sys
+import threading
 import time
 from abc import ABC
 from io import BytesIO
+from urllib.parse import urlparse
 
-import ffmpeg
-import m3u8
-from jsonfinder import jsonfinder
 from lxml import etree, html
 
 import pycurl
@@ -38,34 +36,206 @@ import pycurl
 logging.basicConfig(level=logging.INFO)
 
 API_ROOT = 'http://www.sbs.com.au/api/'
+DATABASE_PATH = 'sbs_ondemand.db'
+HTTP_CACHE_MAX_AGE = 60 * 60
 MAX_RETRIES = 3
 
+# Negotiate HTTP/2 over TLS when both pycurl and the underlying libcurl support it.
+HTTP2_SUPPORTED = (
+    hasattr(pycurl, 'CURL_HTTP_VERSION_2TLS') and
+    bool(pycurl.version_info()[4] & getattr(pycurl, 'VERSION_HTTP2', 0))
+)
 
-def get_with_retry(url):
+# Element IDs are never looked up, so skip collecting them while parsing.
+SMIL_PARSER = etree.XMLParser(remove_blank_text=True, collect_ids=False)
+HTML_PARSER = html.HTMLParser(collect_ids=False)
+
+SMIL_NAMESPACES = {'smil': 'http://www.w3.org/2005/SMIL21/Language'}
+SMIL_VIDEO_XPATH = etree.XPath(
+    '//smil:body/smil:seq/smil:par/smil:video|//smil:body/smil:seq/smil:video',
+    namespaces=SMIL_NAMESPACES,
+)
+SMIL_SRT_XPATH = etree.XPath(
+    '//smil:body/smil:seq/smil:par/smil:textstream[@type="text/srt"][not(@lang)]',
+    namespaces=SMIL_NAMESPACES,
+)
+
+
+class CurlPool(threading.local):
+    """Per-thread Curl handles keyed by host, so that connections are kept alive between requests."""
+
+    def __init__(self):
+        super().__init__()
+        self._handles = {}
+
+    def get(self, url):
+        host = urlparse(url).netloc
+
+        c = self._handles.get(host)
+        if c is None:
+            c = pycurl.Curl()
+            c.setopt(c.FOLLOWLOCATION, True)
+            c.setopt(c.FORBID_REUSE, False)
+            c.setopt(c.TCP_KEEPALIVE, True)
+            # An empty value requests every encoding libcurl can decode, and the response is decoded transparently.
+            c.setopt(c.ACCEPT_ENCODING, '')
+            if HTTP2_SUPPORTED:
+                c.setopt(c.HTTP_VERSION, pycurl.CURL_HTTP_VERSION_2TLS)
+            self._handles[host] = c
+
+        return c
+
+
+curl_pool = CurlPool()
+
+
+class HTTPCache(threading.local):
+    """Per-thread access to the API responses cached in the application database."""
+
+    def __init__(self):
+        super().__init__()
+        self._connection = None
+
+    def _cursor(self):
+        if self._connection is None:
+            self._connection = sqlite3.connect(DATABASE_PATH)
+            self._connection.execute('PRAGMA synchronous=NORMAL')
+
+        return self._connection.cursor()
+
+    def get(self, url):
+        cursor = self._cursor()
+        cursor.execute('SELECT body, etag, last_modified, fetched_at FROM http_cache WHERE url = ?', (url,))
+        return cursor.fetchone()
+
+    def store(self, url, body, etag, last_modified):
+        cursor = self._cursor()
+        cursor.execute(
+            'INSERT OR REPLACE INTO http_cache VALUES(?, ?, ?, ?, ?)',
+            (url, body, etag, last_modified, time.time())
+        )
+        self._connection.commit()
+
+    def refresh(self, url):
+        cursor = self._cursor()
+        cursor.execute('UPDATE http_cache SET fetched_at = ? WHERE url = ?', (time.time(), url))
+        self._connection.commit()
+
+
+http_cache = HTTPCache()
+
+
+def _perform_with_retry(url, fileobj, request_headers=(), response_headers=None):
     retries_left = MAX_RETRIES
 
-    c = pycurl.Curl()
+    if response_headers is None:
+        response_headers = {}
+
+    def header_function(line):
+        line = line.decode('iso-8859-1')
+        if line.startswith('HTTP/'):
+            # A new response has started, e.g. after following a redirect.
+            response_headers.clear()
+        elif ':' in line:
+            name, value = line.split(':', 1)
+            response_headers[name.strip().lower()] = value.strip()
+
+    c = curl_pool.get(url)
     c.setopt(c.URL, url)
-    c.setopt(c.FOLLOWLOCATION, True)
+    c.setopt(c.WRITEDATA, fileobj)
+    c.setopt(c.HEADERFUNCTION, header_function)
+    if request_headers:
+        c.setopt(c.HTTPHEADER, list(request_headers))
+    else:
+        c.unsetopt(c.HTTPHEADER)
 
     while retries_left > 0:
-        buffer = BytesIO()
-        c.setopt(c.WRITEDATA, buffer)
+        # Discard the body of any failed attempt.
+        fileobj.seek(0)
+        fileobj.truncate()
         c.perform()
 
         response_code = c.getinfo(c.RESPONSE_CODE)
-        if response_code == 200:
-            c.close()
-
-            value = buffer.getvalue()
-            encoding = chardet.detect(value)
-
-            return value.decode(encoding['encoding'])
+        if response_code in (200, 304):
+            return response_code
 
         retries_left -= 1
         time.sleep(1)
 
-    c.close()
+    return None
+
+
+def _get_cached(url):
+    request_headers = []
+
+    cached = http_cache.get(url)
+    if cached is not None:
+        body, etag, last_modified, fetched_at = cached
+        if time.time() - fetched_at < HTTP_CACHE_MAX_AGE:
+            return body
+
+        # The cached response is stale, so check whether it has changed.
+        if etag:
+            request_headers.append('If-None-Match: {}'.format(etag))
+        if last_modified:
+            request_headers.append('If-Modified-Since: {}'.format(last_modified))
+
+    buffer = BytesIO()
+    response_headers = {}
+    response_code = _perform_with_retry(url, buffer, request_headers, response_headers)
+    if response_code is None:
+        # A stale response is better than none when the server can't be reached.
+        return cached[0] if cached is not None else None
+
+    if response_code == 304:
+        # Only sent in reply to a conditional request, so there is always a cached response.
+        http_cache.refresh(url)
+        return cached[0]
+
+    body = buffer.getvalue()
+    http_cache.store(url, body, response_headers.get('etag'), response_headers.get('last-modified'))
+    return body
+
+
+def get_with_retry(url):
+    if url.startswith(API_ROOT):
+        # API responses rarely change between runs, so they are cached.
+        return _get_cached(url)
+
+    buffer = BytesIO()
+    if _perform_with_retry(url, buffer) is None:
+        return None
+
+    return buffer.getvalue()
+
+
+def get_with_retry_to_file(url, fileobj):
+    """Write the response body directly to a file opened in binary mode."""
+    return _perform_with_retry(url, fileobj) is not None
+
+
+def find_json_object(text, key):
+    """Return the first JSON object in text that directly contains key, or None if there is none."""
+    decoder = json.JSONDecoder()
+    quoted_key = '"{}"'.format(key)
+
+    index = text.find(quoted_key)
+    while index >= 0:
+        # Try each opening brace to the left of the key, innermost first, until one parses to an object holding it.
+        start = text.rfind('{', 0, index)
+        while start >= 0:
+            try:
+                obj, end = decoder.raw_decode(text, start)
+            except ValueError:
+                pass
+            else:
+                if end > index and isinstance(obj, dict) and key in obj:
+                    return obj
+
+            start = text.rfind('{', 0, start)
+
+        index = text.find(quoted_key, index + 1)
+
     return None
 
 
@@ -83,7 +253,7 @@ class SBSOnDemandAsset(ABC):
 class SBSOnDemandTVProgram(SBSOnDemandAsset):
     def _process_episodes(self, episodes):
         for episode in episodes:
-            video_id = episode['id'][episode['id'].rfind('/') + 1:]
+            video_id = episode['id'].rpartition('/')[2]
 
             self._episodes.append({
                 'title': episode['title'],
@@ -171,7 +341,7 @@ class SBSOnDemandMovie(SBSOnDemandAsset):
         super().__init__()
 
         self._title = data['title']
-        self._id = data['id'][data['id'].rfind('/') + 1:]
+        self._id = data['id'].rpartition('/')[2]
 
 
 def sigint_handler(sig, frame):
@@ -181,11 +351,15 @@ def sigint_handler(sig, frame):
 
 class SBSOnDemand(object):
     MAX_RESULTS = 10
+    SYNC_THREADS = 16
+    METADATA_THREADS = 16
 
     _connection = None
 
     def __enter__(self):
-        self._connection = sqlite3.connect('sbs_ondemand.db')
+        self._connection = sqlite3.connect(DATABASE_PATH, isolation_level=None)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
         self.create_tables()
         return self
 
@@ -194,6 +368,7 @@ class SBSOnDemand(object):
 
     def create_tables(self):
         cursor = self._connection.cursor()
+        cursor.execute('BEGIN')
 
         cursor.execute(
             '''
@@ -215,7 +390,21 @@ class SBSOnDemand(object):
             '''
         )
 
-        self._connection.commit()
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_episodes_title_id ON sbs_tv_episodes(title_id);')
+
+        cursor.execute(
+            '''
+            CREATE TABLE IF NOT EXISTS http_cache (
+                url text PRIMARY KEY,
+                body blob NOT NULL,
+                etag text,
+                last_modified text,
+                fetched_at real NOT NULL
+            );
+            '''
+        )
+
+        cursor.execute('COMMIT')
 
     @staticmethod
     def movie_list():
@@ -235,89 +424,137 @@ class SBSOnDemand(object):
         r = get_with_retry('{}video_programs/all?upcoming=1'.format(API_ROOT))
         return json.loads(r)['entries']
 
-    def synchronise(self):
-        cursor = self._connection.cursor()
+    @staticmethod
+    def _fetch_program(program):
+        logging.info('Fetching data for {}'.format(program['name']))
+        try:
+            return SBSOnDemandTVProgram(program)
+        except RuntimeError:
+            return None
+        except (KeyError, TypeError, ValueError, pycurl.error):
+            # Skip a program with missing or unfetchable data rather than losing the whole sync.
+            logging.exception('Unable to process program {}'.format(program['name']))
+            return None
 
+    def synchronise(self):
+        movies = []
         for movie in self.movie_list():
             logging.info('Fetching data for {}'.format(movie['title']))
-            m = SBSOnDemandMovie(movie)
+            movies.append(SBSOnDemandMovie(movie))
 
-            cursor.execute('INSERT OR IGNORE INTO sbs_titles VALUES(?, ?)', (m.id(), m.title()))
-
-        self._connection.commit()
+        # Fetching the episodes of each program is latency bound, so do it concurrently.
+        with concurrent.futures.ThreadPoolExecutor(max_workers=SBSOnDemand.SYNC_THREADS) as executor:
+            programs = list(executor.map(SBSOnDemand._fetch_program, self.program_list()))
 
-        for program in self.program_list():
-            logging.info('Fetching data for {}'.format(program['name']))
-            try:
-                p = SBSOnDemandTVProgram(program)
-            except RuntimeError:
+        titles_rows = [(m.id(), m.title()) for m in movies]
+        episode_rows = []
+        for p in programs:
+            if p is None:
                 continue
 
-            cursor = self._connection.cursor()
+            titles_rows.append((p.id(), p.title()))
+            episode_rows.extend((episode['id'], episode['title'], p.id()) for episode in p.episodes())
 
-            cursor.execute('INSERT OR IGNORE INTO sbs_titles VALUES(?, ?)', (p.id(), p.title()))
-            for episode in p.episodes():
-                cursor.execute(
-                    'INSERT OR IGNORE INTO sbs_tv_episodes VALUES(?, ?, ?)',
-                    (episode['id'], episode['title'], p.id())
-                )
+        # Write everything in one explicit transaction, once all fetching (and HTTP cache writes) are done.
+        cursor = self._connection.cursor()
+        cursor.execute('BEGIN')
+        try:
+            cursor.executemany('INSERT OR IGNORE INTO sbs_titles VALUES(?, ?)', titles_rows)
+            cursor.executemany('INSERT OR IGNORE INTO sbs_tv_episodes VALUES(?, ?, ?)', episode_rows)
+        except Exception:
+            cursor.execute('ROLLBACK')
+            raise
 
-            self._connection.commit()
+        cursor.execute('COMMIT')
 
     @staticmethod
-    def save_video(url, output_dir):
-        smil_url = get_with_retry(url)
-        smil_tree = etree.fromstring(smil_url)
-        namespace = {'smil': 'http://www.w3.org/2005/SMIL21/Language'}
-
-        video_tree = smil_tree.xpath(
-            '//smil:body/smil:seq/smil:par/smil:video|//smil:body/smil:seq/smil:video',
-            namespaces=namespace,
-        )
-        srt_tree = smil_tree.xpath(
-            '//smil:body/smil:seq/smil:par/smil:textstream[@type="text/srt"][not(@lang)]',
-            namespaces=namespace,
-        )
+    def prepare_video(url):
+        """Return the title, stream URI and subtitles URL (or None) of a video, or None on failure."""
+        # Only needed for downloads, so avoid the import cost for the other commands.
+        import m3u8
 
-        title = video_tree[0].attrib['title']
+        smil_body = get_with_retry(url)
+        smil_tree = etree.fromstring(smil_body, parser=SMIL_PARSER)
 
-        if srt_tree:
-            # Subtitles found.
-            srt_url = srt_tree[0].attrib['src']
+        video_tree = SMIL_VIDEO_XPATH(smil_tree)
+        srt_tree = SMIL_SRT_XPATH(smil_tree)
 
-            output_path = os.path.join(output_dir, '{}.srt'.format(title))
-            with open(output_path, 'w') as f:
-                srt_content = get_with_retry(srt_url)
-                f.write(srt_content)
+        title = video_tree[0].attrib['title']
+        srt_url = srt_tree[0].attrib['src'] if srt_tree else None
 
         video_url = video_tree[0].attrib['src']
 
-        m3u8_obj = m3u8.load(video_url)
-        best_quality = max(m3u8_obj.playlists, key=lambda p: p.stream_info.bandwidth)
-        stream_uri = best_quality.uri
+        # Fetch the playlist over the pooled connection rather than letting m3u8 open a new one.
+        playlist_body = get_with_retry(video_url)
+        if playlist_body is None:
+            logging.error('Unable to fetch playlist for {}'.format(title))
+            return None
+
+        m3u8_obj = m3u8.loads(playlist_body.decode('utf-8'))
+
+        best_quality = None
+        best_bandwidth = -1
+        for playlist in m3u8_obj.playlists:
+            bandwidth = playlist.stream_info.bandwidth
+            if bandwidth > best_bandwidth:
+                best_quality, best_bandwidth = playlist, bandwidth
+
+        return title, best_quality.uri, srt_url
+
+    @staticmethod
+    def save_video(title, stream_uri, srt_url, output_dir):
+        import ffmpeg
+
+        if srt_url:
+            # Subtitles found.
+            output_path = os.path.join(output_dir, '{}.srt'.format(title))
+            saved = False
+            with open(output_path, 'wb') as f:
+                try:
+                    saved = get_with_retry_to_file(srt_url, f)
+                finally:
+                    # Don't leave an empty or partial subtitle file behind.
+                    if not saved:
+                        f.close()
+                        os.remove(output_path)
+
+            if not saved:
+                logging.error('Unable to download subtitles for {}'.format(title))
 
         output_path = os.path.join(output_dir, '{}.mp4'.format(title))
         ffmpeg.input(stream_uri).output(output_path, codec='copy', loglevel='warning').run()
 
     @staticmethod
-    def fetch_video_url(video_id, file_number, title, total, output_dir):
-        logging.info('Downloading {} of {}: {}'.format(file_number, total, title))
-
+    def fetch_video_url(video_id):
         r = get_with_retry('https://www.sbs.com.au/ondemand/video/single/{}?context=web'.format(video_id))
-        tree = html.fromstring(r)
+        tree = html.fromstring(r, parser=HTML_PARSER)
 
-        script_tags = tree.xpath('//head/script')
+        head = tree.find('head')
+        script_tags = head.iterchildren('script') if head is not None else ()
 
         for tag in script_tags:
-            if tag.text:
-                for _, _, obj in jsonfinder(tag.text):
-                    if obj and 'playerURL' in obj:
-                        SBSOnDemand.save_video(obj['releaseUrls']['htmldesktop'], output_dir=output_dir)
-                        break
+            if not tag.text:
+                continue
+
+            obj = find_json_object(tag.text, 'playerURL')
+            if obj:
+                return SBSOnDemand.prepare_video(obj['releaseUrls']['htmldesktop'])
+
+        return None
 
     @staticmethod
-    def _fetch_video_url_wrapper(kwargs):
-        SBSOnDemand.fetch_video_url(**kwargs)
+    def _download_episode(transcode_slots, stopping, video_id, file_number, title, total, output_dir):
+        video = SBSOnDemand.fetch_video_url(video_id)
+        if video is None or stopping.is_set():
+            return
+
+        with transcode_slots:
+            # Don't start saving another video once the download has been interrupted.
+            if stopping.is_set():
+                return
+
+            logging.info('Downloading {} of {}: {}'.format(file_number, total, title))
+            SBSOnDemand.save_video(*video, output_dir=output_dir)
 
     def download(self, title, output_dir, download_threads):
         cursor = self._connection.cursor()
@@ -327,7 +564,7 @@ class SBSOnDemand(object):
             ('%{}%'.format(title.lower()), SBSOnDemand.MAX_RESULTS + 1)
         )
 
-        results = list(cursor.fetchall())
+        results = cursor.fetchmany(SBSOnDemand.MAX_RESULTS + 1)
 
         if len(results) == 0:
             logging.info('No results')
@@ -346,27 +583,55 @@ class SBSOnDemand(object):
 
         cursor.execute('SELECT episode_id, title FROM sbs_tv_episodes WHERE title_id = ?', (title_id,))
 
-        episodes = list(cursor.fetchall())
+        episodes = cursor.fetchall()
         if not episodes:
             # Download the movie.
-            SBSOnDemand.fetch_video_url(title_id, 1, video_title, 1, output_dir)
+            video = SBSOnDemand.fetch_video_url(title_id)
+            if video is not None:
+                logging.info('Downloading {} of {}: {}'.format(1, 1, video_title))
+                SBSOnDemand.save_video(*video, output_dir=output_dir)
             return
 
         # This is a TV series, so download the episodes.
         total_episodes = len(episodes)
-        args = []
-        for index, (episode_id, episode_title) in enumerate(episodes):
-            kwargs = {
-                'video_id': episode_id,
-                'file_number': index + 1,
-                'title': episode_title,
-                'total': total_episodes,
-                'output_dir': output_dir,
-            }
-            args.append(kwargs)
 
-        pool = multiprocessing.Pool(processes=download_threads)
-        pool.map(SBSOnDemand._fetch_video_url_wrapper, args)
+        # Resolve the streams of upcoming episodes while earlier ones are being saved, but run no more than
+        # download_threads ffmpeg processes at once. The work is I/O bound, so threads are enough.
+        transcode_slots = threading.BoundedSemaphore(download_threads)
+        stopping = threading.Event()
+        max_workers = max(SBSOnDemand.METADATA_THREADS, download_threads)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [
+                executor.submit(
+                    SBSOnDemand._download_episode,
+                    transcode_slots,
+                    stopping,
+                    video_id=episode_id,
+                    file_number=index + 1,
+                    title=episode_title,
+                    total=total_episodes,
+                    output_dir=output_dir,
+                )
+                for index, (episode_id, episode_title) in enumerate(episodes)
+            ]
+
+            try:
+                for future in futures:
+                    future.result()
+            except (KeyboardInterrupt, SystemExit):
+                # Otherwise leaving the executor would wait for every queued and running download to complete.
+                stopping.set()
+                for future in futures:
+                    future.cancel()
+                raise
+
+
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError('must be at least 1')
+
+    return number
 
 
 def main():
@@ -387,7 +652,7 @@ def main():
     download_parser.add_argument(
         '-n',
         '--download-threads',
-        type=int,
+        type=positive_int,
         default=DEFAULT_DOWNLOAD_THREADS_COUNT,
         dest='download_threads',
         help='The number of files to download concurrently. Default is {}.'.format(DEFAULT_DOWNLOAD_THREADS_COUNT),